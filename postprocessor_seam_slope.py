@@ -1,11 +1,63 @@
 #!/usr/bin/python
 import argparse
+from bisect import bisect_right
+from collections import OrderedDict
+import importlib
 import math
 from enum import Enum
+from itertools import accumulate
 import re
 import os
+import sys
+import time
 from typing import List
 
+LAYER_CHANGE_MARKER = ";LAYER_CHANGE"
+LAYER_Z_MARKER = ";Z:"
+COMMAND_ENDS = (b"", b" ", b"\t", b";", b"\r", b"\n")
+OUTER_WALL_TYPES = [";TYPE:Outer wall", ";TYPE:WALL-OUTER", ";TYPE:External perimeter"]
+SLOPE_PATH_MACRO = "SEAM_SLOPE_PATH"
+SLOPE_RAMP_MACRO = "SEAM_SLOPE"
+SLOPE_MACROS_CONFIG = """# Klipper macros for the files made by postprocessor_seam_slope.py with --compact_slopes
+# Include this file in printer.cfg
+
+[gcode_macro SEAM_SLOPE_PATH]
+description: Store the points of a sloped loop in the slot ID, X:Y:E:step separated by |. CLEAR=1 drops all slots
+variable_paths: {}
+gcode:
+  {% if params.CLEAR %}
+    {% set paths = {} %}
+  {% else %}
+    {% set paths = printer["gcode_macro SEAM_SLOPE_PATH"].paths %}
+    {% set _ = paths.update({params.ID: params.POINTS}) %}
+  {% endif %}
+  SET_GCODE_VARIABLE MACRO=SEAM_SLOPE_PATH VARIABLE=paths VALUE="{paths}"
+
+[gcode_macro SEAM_SLOPE]
+description: Print a sloped loop stored by SEAM_SLOPE_PATH
+gcode:
+  {% set points = printer["gcode_macro SEAM_SLOPE_PATH"].paths[params.PATH].split("|") %}
+  {% set z_floor = params.Z_FLOOR|float %}
+  {% set z_end = params.Z_END|float %}
+  {% set height = z_end - z_floor %}
+  {% set start_ratio = params.START_RATIO|float %}
+  {% set steps = params.STEPS|int %}
+  {% set ratio_per_step = (1 - start_ratio) / steps %}
+  G1 Z{"%.3f" % (z_floor + height * ratio_per_step)}
+  {% for point in points %}
+    {% set x, y, e, step = point.split(":") %}
+    {% set ratio = start_ratio + ratio_per_step * (step|int) %}
+    G1 X{x} Y{y} Z{"%.3f" % (z_floor + height * ratio)} E{"%.5f" % ((e|float) * ratio)}{% if loop.first and params.F %} F{params.F}{% endif %}
+  {% endfor %}
+  {% for point in points %}
+    {% set x, y, e, step = point.split(":") %}
+    {% if (step|int) < steps %}
+      {% set ratio = start_ratio + ratio_per_step * (step|int) %}
+      G1 X{x} Y{y} Z{"%.3f" % z_end} E{"%.5f" % ((e|float) * (1 - ratio))}
+    {% endif %}
+  {% endfor %}
+"""
+
 
 class Line:
     def __init__(self, xy1: tuple, xy2: tuple):
@@ -96,7 +148,7 @@ class Gcode:
                         string += f' {st.name}{Gcode._format_number(st.value, 3)}'
                     elif st.name == "E":
                         string += f' {st.name}{Gcode._format_number(st.value, 3)}'  # 1 micron is for sure enough accuracy for extrude move
-                        if self.is_xy_movement() is False:
+                        if self.command == "G1" and self.is_xy_movement() is False and not self.extrude_is_absolute:
                             comment = None
                             if st.value < 0:
                                 comment = "retract"
@@ -243,8 +295,7 @@ class Gcode:
 
     def is_outer_perimeter(self):
         if self.command is not None:
-            outer_wall_types = [";TYPE:Outer wall", ";TYPE:WALL-OUTER", ";TYPE:External perimeter"]
-            if self.command in outer_wall_types:
+            if self.command in OUTER_WALL_TYPES:
                 return True
             elif self.command.startswith(";TYPE:"):
                 return False
@@ -277,6 +328,27 @@ class Gcode:
             return found.value
 
 
+class SlopeRampGcode(Gcode):
+    """
+    Sloped loop written as one macro call, the commands run by the macro are kept for verification
+    """
+
+    def __init__(self, command: str, expanded: List[Gcode], comment: str = None):
+        super().__init__(command=command, comment=comment)
+        self.expanded = expanded
+
+    def extruded(self) -> float:
+        return sum(gcode.get_param("E") for gcode in self.expanded if gcode.is_extruder_move())
+
+
+def expand_slope_ramps(gcodes: List[Gcode]):
+    for gcode in gcodes:
+        if isinstance(gcode, SlopeRampGcode):
+            yield from gcode.expanded
+        else:
+            yield gcode
+
+
 def validate_gcode_command_string(string):
     # The pattern matches a letter followed by a positive number or zero
     pattern = re.compile("^[A-Za-z][0-9]+$")
@@ -358,35 +430,218 @@ def delete_file_if_exists(file_path):
 
 
 def read_gcode_file(path: str) -> List[Gcode]:
-    gcodes = []
     print("Read gcode file to memory")
     with open(path, "r", encoding='utf8') as readfile:
         lines = readfile.readlines()
-        last_state = None
-        num_line = 1
-        for line in lines:
-            gcode = parse_gcode_line(line, last_state)
-            if gcode.command == "G90":  # enable absolute coordinates
-                gcode.move_is_absolute = True
-            elif gcode.command == "G91":  # enable relative coordinates
-                gcode.move_is_absolute = False
-            elif gcode.command == "M82":  # enable absolute distances for extrusion
-                gcode.extrude_is_absolute = True
-            elif gcode.command == "M83":  # enable relative distances for extrusion
-                gcode.extrude_is_absolute = False
-            last_state = gcode.state()
-            gcode.num_line = num_line
-            num_line += 1
+    readfile.close()
+    return parse_gcode_lines(lines)
 
-            z_value = gcode.get_param("Z")
-            if z_value is not None and z_value > gcode.previous_state.Z:
-                gcode.comment = "Z lift"
 
-            gcodes.append(gcode)
-    readfile.close()
+def parse_gcode_lines(lines: List[str], last_state: State = None, first_num_line: int = 1) -> List[Gcode]:
+    gcodes = []
+    num_line = first_num_line
+    for line in lines:
+        gcode = parse_gcode_line(line, last_state)
+        if gcode.command == "G90":  # enable absolute coordinates
+            gcode.move_is_absolute = True
+        elif gcode.command == "G91":  # enable relative coordinates
+            gcode.move_is_absolute = False
+        elif gcode.command == "M82":  # enable absolute distances for extrusion
+            gcode.extrude_is_absolute = True
+        elif gcode.command == "M83":  # enable relative distances for extrusion
+            gcode.extrude_is_absolute = False
+        last_state = gcode.state()
+        gcode.num_line = num_line
+        num_line += 1
+
+        z_value = gcode.get_param("Z")
+        if z_value is not None and z_value > gcode.previous_state.Z:
+            gcode.comment = "Z lift"
+
+        gcodes.append(gcode)
     return gcodes
 
 
+def scan_layers(data: bytes) -> List[tuple]:
+    """
+    Find layer change markers without parsing the file
+    :param data: content of the gcode file
+    :return: (byte offset of the marker line, layer Z or None) for every layer
+    """
+    layers = []
+    marker = b"\n" + LAYER_CHANGE_MARKER.encode()
+    z_marker = LAYER_Z_MARKER.encode()
+    position = 0 if data.startswith(marker[1:]) else data.find(marker)
+    while position != -1:
+        start = position if position == 0 else position + 1
+        line_end = data.find(b"\n", start)
+        z = None
+        if line_end != -1 and data.startswith(z_marker, line_end + 1):
+            z_end = data.find(b"\n", line_end + 1)
+            try:
+                z = float(data[line_end + 1 + len(z_marker): None if z_end == -1 else z_end])
+            except ValueError:
+                pass
+        layers.append((start, z))
+        position = data.find(marker, start + 1)
+    return layers
+
+
+def parse_layer_numbers(string: str) -> set:
+    """
+    :param string: layer numbers counted from 1, like "5-20,30"
+    :return:
+    """
+    numbers = set()
+    for part in string.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if "-" in part:
+                first, last = part.split("-", 1)
+                first, last = int(first), int(last)
+            else:
+                first = last = int(part)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"'{part}' is not a layer number or a range like 5-20")
+        if first < 1 or last < first:
+            raise argparse.ArgumentTypeError(f"'{part}' is not a valid layer range, layers are counted from 1")
+        numbers.update(range(first, last + 1))
+    if len(numbers) == 0:
+        raise argparse.ArgumentTypeError("no layers are listed")
+    return numbers
+
+
+def select_layer_regions(layers: List[tuple], data_length: int, z_min: float = None, z_max: float = None,
+                         layer_numbers: set = None) -> List[tuple]:
+    """
+    Merge the selected layers in to continuous byte regions
+    :param layers: result of scan_layers
+    :param data_length:
+    :param z_min:
+    :param z_max:
+    :param layer_numbers: layer numbers counted from 1
+    :return: (start byte offset, end byte offset) of every region
+    """
+    regions = []
+    for layer_id, (start, z) in enumerate(layers):
+        selected = layer_numbers is None or layer_id + 1 in layer_numbers
+        if z_min is not None and (z is None or z < z_min):
+            selected = False
+        if z_max is not None and (z is None or z > z_max):
+            selected = False
+        if not selected:
+            continue
+
+        end = layers[layer_id + 1][0] if layer_id + 1 < len(layers) else data_length
+        if len(regions) > 0 and regions[-1][1] == start:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+
+def _find_last_command(data: bytes, command: bytes, start: int, end: int) -> int:
+    """
+    :return: offset of the last line in data[start:end] beginning with the command or -1
+    """
+    position = end
+    while True:
+        position = data.rfind(b"\n" + command, max(start - 1, 0), position)
+        if position == -1:
+            if start == 0 and data.startswith(command) and data[len(command):len(command) + 1] in COMMAND_ENDS:
+                return 0
+            return -1
+        if data[position + 1 + len(command): position + 2 + len(command)] in COMMAND_ENDS:
+            return position + 1
+
+
+def find_loop_closing_travel(data: bytes, start: int, end: int, state: State) -> int:
+    """
+    Find the first XY move without extrusion after a region, it closes a loop left open at the end of the region
+    :param data: content of the gcode file
+    :param start: end of the region
+    :param end: offset where the search stops
+    :param state: state at the end of the region
+    :return: offset after the line of the move or end if there is none
+    """
+    offset = start
+    while offset < end:
+        line_end = data.find(b"\n", offset, end)
+        line_end = end if line_end == -1 else line_end + 1
+        gcode = parse_gcode_lines([data[offset:line_end].decode('utf8')], state)[0]
+        state = gcode.state()
+        offset = line_end
+        if gcode.is_xy_movement() and gcode.is_extruder_move() is False:
+            return offset
+    return end
+
+
+def seed_state(data: bytes, start: int, end: int, state: State) -> State:
+    """
+    Printer state at the end offset. Only the lines between start and end are looked at,
+    walking back from the end as far as needed, anything not found there is taken from the state at start
+    :param data: content of the gcode file
+    :param start: byte offset where the state is known
+    :param end: byte offset of the first line that is going to be parsed
+    :param state: printer state at the start offset
+    :return:
+    """
+    last_g90 = _find_last_command(data, b"G90", start, end)
+    last_g91 = _find_last_command(data, b"G91", start, end)
+    if last_g91 != -1 or not state.move_is_absolute:  # relative coordinates can't be found backwards
+        lines = data[start:end].decode('utf8').splitlines()
+        return state.clone() if len(lines) == 0 else parse_gcode_lines(lines, state)[-1].state()
+
+    state = state.clone()
+    if last_g90 != -1:
+        state.move_is_absolute = True
+    last_m82 = _find_last_command(data, b"M82", start, end)
+    last_m83 = _find_last_command(data, b"M83", start, end)
+    if last_m82 != -1 or last_m83 != -1:
+        state.extrude_is_absolute = last_m82 > last_m83
+
+    type_start = data.rfind(b"\n;TYPE:", max(start - 1, 0), end)
+    if type_start != -1:
+        type_end = data.find(b"\n", type_start + 1)
+        type_line = data[type_start + 1: type_end].decode('utf8').strip()
+        state.is_outer_perimeter = type_line in OUTER_WALL_TYPES
+
+    wanted = {"X", "Y", "Z", "E"} if state.extrude_is_absolute else {"X", "Y", "Z"}
+    line_end = end
+    while len(wanted) > 0 and line_end > start:
+        line_start = max(data.rfind(b"\n", start, line_end - 1) + 1, start)
+        line = data[line_start:line_end]
+        line_end = line_start
+        if not line.startswith((b"G0", b"G1", b"G92", b"G28")):
+            continue
+        parts = line.split(b";", 1)[0].split()
+        command = parts[0].decode('utf8')
+        if command not in ("G0", "G1", "G92", "G28"):
+            continue
+        if command == "G28":
+            axes = [part[:1].decode('utf8') for part in parts[1:]]
+            for axis in ("X", "Y", "Z"):
+                if axis in wanted and (axis in axes or not axes):
+                    setattr(state, axis, 0)
+                    wanted.discard(axis)
+            continue
+        for part in parts[1:]:
+            name = part[:1].decode('utf8')
+            if name in wanted:
+                try:
+                    setattr(state, name, float(part[1:]))
+                    wanted.discard(name)
+                except ValueError:
+                    pass
+
+    for axis in ("X", "Y", "Z", "E"):
+        if getattr(state, axis) is None:
+            setattr(state, axis, 0)
+    return state
+
+
 def calculate_length_of_lines(sliced: List[Gcode]) -> float:
     length = 0
     for gcode in sliced:
@@ -402,37 +657,37 @@ def find_closed_loops(gcodes: List[Gcode],
                       max_distance_start_end: float,
                       min_loop_length: float,
                       first_layer_height: float):
+    """
+    :return: start end indexes of the closed loops and the start index of a loop which is not finished yet or None
+    """
     loops = []
-    start = None
-    end = None
+    start_index = None
+    end_index = None
     for gcode_id in range(len(gcodes)):
         gcode = gcodes[gcode_id]
         if gcode.is_xy_movement() is False:
             continue
 
         if gcode.is_extruder_move():
-            if start is None and gcode.state().Z > first_layer_height and gcode.is_outer_perimeter():
-                start = gcode
-                end = gcode
+            if start_index is None and gcode.state().Z > first_layer_height and gcode.is_outer_perimeter():
+                start_index = gcode_id
+                end_index = gcode_id
             else:
-                end = gcode
+                end_index = gcode_id
 
-        if start is not None and gcode.is_extruder_move() is False:
-            start_state = start.previous_state
-            end_state = end.state()
+        if start_index is not None and gcode.is_extruder_move() is False:
+            start_state = gcodes[start_index].previous_state
+            end_state = gcodes[end_index].state()
             distance = distance_between_points(start_state.X, start_state.Y, end_state.X, end_state.Y)
             if distance < max_distance_start_end:
-                start_index = gcodes.index(start)
-                end_index = gcodes.index(end)
                 sliced = gcodes[start_index:end_index + 1]
                 loop_length = calculate_length_of_lines(sliced)
                 if loop_length > min_loop_length:
                     loops.append((start_index, end_index))
-                    print(f"Found a loop number {len(loops)}")
-            start = None
-            end = None
+            start_index = None
+            end_index = None
 
-    return loops
+    return loops, start_index
 
 
 def vector_from_points(p1, p2):
@@ -570,43 +825,122 @@ def remove_very_little_moves(for_return, tolerance: float = 0.01):
     return without_short_movements
 
 
-def modify_loop_with_slope(loop_gcodes: List[Gcode], slope_steps: int, layer_height: float,
-                           start_slope_height: float) -> \
-        List[Gcode]:
+EXTRUSION_TOLERANCE = 0.0001  # E difference in mm for moves to be considered the same
+
+
+def loop_shape_key(loop_gcodes: List[Gcode], tolerance: float, *parameters):
     """
-    generate gcode with slopes
-    :param start_slope_height:
+    Key of the loop polyline quantized to the tolerance. E of the moves is kept apart from the key:
+    E values converted from absolute extrude carry rounding noise, so they are compared with EXTRUSION_TOLERANCE
     :param loop_gcodes:
-    :param layer_height:
-    :param slope_steps:
-    :return:
+    :param tolerance: XY tolerance in mm
+    :param parameters: other values the key depends on
+    :return: (key, E of every XY move) or None if the loop can't be keyed
     """
+    first_state = loop_gcodes[0].previous_state
+    if first_state is None or first_state.X is None or first_state.Y is None:
+        return None
+
+    key = list(parameters) + [round(first_state.X / tolerance), round(first_state.Y / tolerance)]
+    extrusions = []
+    for gcode in loop_gcodes:
+        if not gcode.move_is_absolute:
+            return None
+        if gcode.is_xy_movement() is False:
+            key.append((gcode.command, gcode.comment,
+                        tuple((parameter.name, parameter.value) for parameter in gcode.parameters)))
+            continue
+        x = gcode.get_param("X")
+        y = gcode.get_param("Y")
+        key.append((None if x is None else round(x / tolerance), None if y is None else round(y / tolerance),
+                    gcode.get_param("F"), gcode.get_param("Z")))
+        extrusions.append(gcode.get_param("E"))
+    return tuple(key), tuple(extrusions)
+
 
+def same_extrusions(first: tuple, second: tuple) -> bool:
+    if len(first) != len(second):
+        return False
+    for first_e, second_e in zip(first, second):
+        if first_e is None or second_e is None:
+            if first_e is not second_e:
+                return False
+        elif abs(first_e - second_e) > EXTRUSION_TOLERANCE:
+            return False
+    return True
+
+
+class SlopeTemplateCache:
+    """
+    Sloped loops keyed by their quantized polyline, a loop repeated on the next layers reuses the template with shifted Z
+    """
+
+    def __init__(self, max_size: int = 64, tolerance: float = 0.001):
+        self.max_size = max_size
+        self.tolerance = tolerance
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+
+    def key(self, loop_gcodes: List[Gcode], slope_steps: int, layer_height: float, start_slope_height: float):
+        if self.max_size <= 0:
+            return None
+        return loop_shape_key(loop_gcodes, self.tolerance, slope_steps, layer_height, start_slope_height)
+
+    def get(self, key, layer_level: float):
+        if key is None:
+            return None
+        shape, extrusions = key
+        found = self._templates.get(shape)
+        if found is None or not same_extrusions(found[0], extrusions):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._templates.move_to_end(shape)
+        _, template_level, template_gcodes = found
+        return [_shift_gcode_z(gcode, layer_level - template_level) for gcode in template_gcodes]
+
+    def put(self, key, layer_level: float, modified_loop: List[Gcode]):
+        if key is None:
+            return
+        shape, extrusions = key
+        self._templates[shape] = (extrusions, layer_level, [gcode.clone() for gcode in modified_loop])
+        self._templates.move_to_end(shape)
+        if len(self._templates) > self.max_size:
+            self._templates.popitem(last=False)
+
+
+def _shift_gcode_z(gcode: Gcode, shift: float) -> Gcode:
+    shifted = gcode.clone()
+    z = shifted.get_param("Z")
+    if z is not None:
+        shifted.set_param("Z", z + shift)
+    if shifted.previous_state.Z is not None:
+        shifted.previous_state.Z += shift
+    return shifted
+
+
+def cut_loop_into_slope_steps(loop_gcodes: List[Gcode], slope_steps: int):
+    """
+    Cut the loop in to parts of the same length, one for every slope step
+    :param loop_gcodes:
+    :param slope_steps:
+    :return: (commands without XY movement, XY moves) of every step and the commands left after the last step
+    """
     remaining_gcodes = list(loop_gcodes)
-    first_move_Z = next((gc for gc in loop_gcodes if gc.is_extruder_move() and gc.is_xy_movement()))
-    current_nozzle_finish_height = first_move_Z.state().Z
-    current_layer_level = current_nozzle_finish_height - layer_height
     slope_length = calculate_length_of_lines(loop_gcodes)
     slope_length_per_step = slope_length / slope_steps
-    slope_height_per_step = (layer_height - start_slope_height) / slope_steps
-
-    slope_increase = []
-    slope_decrease = []
-
-    move_to_position_gcode = Gcode(command="G1")
-    move_to_position_gcode.parameters.append(Parameter("Z", current_layer_level + slope_height_per_step))
-    move_to_position_gcode.comment = "Move nozzle in start slope position"
-    slope_increase.append(move_to_position_gcode)
 
+    steps = []
     for step in range(1, slope_steps + 1):
         slope_length_per_step_left = slope_length_per_step
-        slope_height = slope_height_per_step * step + start_slope_height
-        slope_increase_step_gcodes = []
+        step_other_gcodes = []
+        step_gcodes = []
         while round(slope_length_per_step_left, 6) > 0:
             if len(remaining_gcodes) == 0:
                 break
             if remaining_gcodes[0].is_xy_movement() is False:  # any change of speed and acceleration
-                slope_increase.append(remaining_gcodes[0])
+                step_other_gcodes.append(remaining_gcodes[0])
                 remaining_gcodes.remove(remaining_gcodes[0])
                 continue
 
@@ -614,14 +948,56 @@ def modify_loop_with_slope(loop_gcodes: List[Gcode], slope_steps: int, layer_hei
             while round(slope_length_per_step_left, 6) > 0:
                 if remaining_gcodes[0].move_length() - slope_length_per_step_left > minimal_line_to_draw:
                     gcode1, gcode2 = cut_gcode(remaining_gcodes[0], slope_length_per_step_left)
-                    slope_increase_step_gcodes.append(gcode1)
+                    step_gcodes.append(gcode1)
                     slope_length_per_step_left -= gcode1.move_length()
                     remaining_gcodes[0] = gcode2
                 else:
                     slope_length_per_step_left -= remaining_gcodes[0].move_length()
-                    slope_increase_step_gcodes.append(remaining_gcodes[0])
+                    step_gcodes.append(remaining_gcodes[0])
                     remaining_gcodes.remove(remaining_gcodes[0])
                     break
+        steps.append((step_other_gcodes, step_gcodes))
+    return steps, remaining_gcodes
+
+
+def modify_loop_with_slope(loop_gcodes: List[Gcode], slope_steps: int, layer_height: float,
+                           start_slope_height: float, cache: SlopeTemplateCache = None) -> \
+        List[Gcode]:
+    """
+    generate gcode with slopes
+    :param start_slope_height:
+    :param loop_gcodes:
+    :param layer_height:
+    :param slope_steps:
+    :param cache: templates of already sloped loops
+    :return:
+    """
+
+    first_move_Z = next((gc for gc in loop_gcodes if gc.is_extruder_move() and gc.is_xy_movement()))
+    current_nozzle_finish_height = first_move_Z.state().Z
+    current_layer_level = current_nozzle_finish_height - layer_height
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(loop_gcodes, slope_steps, layer_height, start_slope_height)
+        template = cache.get(cache_key, current_layer_level)
+        if template is not None:
+            return template
+
+    slope_height_per_step = (layer_height - start_slope_height) / slope_steps
+
+    slope_increase = []
+    slope_decrease = []
+
+    move_to_position_gcode = Gcode(command="G1")
+    move_to_position_gcode.parameters.append(Parameter("Z", current_layer_level + slope_height_per_step))
+    move_to_position_gcode.comment = "Move nozzle in start slope position"
+    slope_increase.append(move_to_position_gcode)
+
+    steps, remaining_gcodes = cut_loop_into_slope_steps(loop_gcodes, slope_steps)
+    for step, (step_other_gcodes, slope_increase_step_gcodes) in enumerate(steps, start=1):
+        slope_height = slope_height_per_step * step + start_slope_height
+        slope_increase.extend(step_other_gcodes)
 
         (slope_increase_step_gcodes,
          slope_decrease_step_gcodes) = make_slope_step_brothers_gcodes(
@@ -650,60 +1026,832 @@ def modify_loop_with_slope(loop_gcodes: List[Gcode], slope_steps: int, layer_hei
     # for_return.insert(0, retract)
 
     for_return = remove_very_little_moves(for_return)
+    if cache is not None:
+        cache.put(cache_key, current_layer_level, for_return)
     return for_return
 
 
-def convert_to_relative_extrude(gcodes: List[Gcode]):
-    gcodes_new = []
-    print("Convert gcode to relative extrude moves")
+def can_compact_loop(loop_gcodes: List[Gcode]) -> bool:
+    """
+    :return: True if the loop has nothing else than XY extrude moves and can be written as a slope macro call
+    """
+    for gcode_id, gcode in enumerate(loop_gcodes):
+        if (gcode.command != "G1" or gcode.is_xy_movement() is False or gcode.is_extruder_move() is False
+                or not gcode.move_is_absolute or gcode.get_param("Z") is not None):
+            return False
+        if gcode_id > 0 and gcode.get_param("F") is not None:  # only the speed of the first move is passed
+            return False
+    return True
+
 
-    first_move = next((gc for gc in gcodes if gc.command == "G1"), None)
-    first_move_id = gcodes.index(first_move)
-    enable_relative_extrude = Gcode(command="M83", comment="enable relative extrude mode")
-    gcodes.insert(first_move_id, enable_relative_extrude)
+def slope_ramp_points(loop_gcodes: List[Gcode], slope_steps: int) -> str:
+    """
+    Points of the loop cut in to slope steps for the slope macro
+    :param loop_gcodes: loop accepted by can_compact_loop
+    :param slope_steps:
+    :return: "X:Y:E:step|..."
+    """
+    steps, remaining_gcodes = cut_loop_into_slope_steps(loop_gcodes, slope_steps)
+    points = []
+    for step, (_, step_gcodes) in enumerate(steps, start=1):
+        points.extend((gcode, step) for gcode in step_gcodes)
+    points.extend((gcode, slope_steps) for gcode in remaining_gcodes)  # left at the full height
+
+    formatted = []
+    for gcode, step in points:
+        state = gcode.state()
+        formatted.append(f"{Gcode._format_number(state.X, 3)}:{Gcode._format_number(state.Y, 3)}:"
+                         f"{Gcode._format_number(gcode.get_param('E'), 5)}:{step}")
+    return "|".join(formatted)
+
+
+def slope_ramp_lines(points: str, z_floor: float, z_end: float, start_ratio: float, steps: int,
+                     speed=None) -> List[str]:
+    """
+    Commands the SEAM_SLOPE macro of SLOPE_MACROS_CONFIG runs for a stored path, computed the same way
+    :param points: "X:Y:E:step|..." as stored by SEAM_SLOPE_PATH
+    :param z_floor: Z_FLOOR of the macro call
+    :param z_end: Z_END of the macro call
+    :param start_ratio: START_RATIO of the macro call
+    :param steps: STEPS of the macro call
+    :param speed: F of the macro call or None
+    :return:
+    """
+    points = [point.split(":") for point in points.split("|")]
+    height = z_end - z_floor
+    ratio_per_step = (1 - start_ratio) / steps
+    lines = ["G1 Z%.3f" % (z_floor + height * ratio_per_step)]
+    for point_id, (x, y, e, step) in enumerate(points):
+        ratio = start_ratio + ratio_per_step * int(step)
+        speed_param = f" F{speed}" if point_id == 0 and speed is not None else ""
+        lines.append(f"G1 X{x} Y{y} Z{'%.3f' % (z_floor + height * ratio)} E{'%.5f' % (float(e) * ratio)}{speed_param}")
+    for x, y, e, step in points:
+        if int(step) < steps:
+            ratio = start_ratio + ratio_per_step * int(step)
+            lines.append(f"G1 X{x} Y{y} Z{'%.3f' % z_end} E{'%.5f' % (float(e) * (1 - ratio))}")
+    return lines
+
+
+def gcode_lines(gcodes: List[Gcode], absolute_extrude: bool = False, start_e: float = 0):
+    """
+    Lines of the output file, relative E values are rewritten to absolute on the fly if needed
+    :param gcodes: commands with relative extrude
+    :param absolute_extrude: write the output with absolute extrude (M82)
+    :param start_e: extruder position before the first command
+    :return:
+    """
+    extruder_position = start_e
     for gcode in gcodes:
+        if absolute_extrude:
+            if gcode.command == "M83":
+                yield "M82 ; enable absolute extrude mode\n"
+                yield f"G92 E{Gcode._format_number(extruder_position, 5)} ; set extruder position\n"
+                continue
+            if isinstance(gcode, SlopeRampGcode):
+                extruder_position += gcode.extruded()
+                yield "M83 ; relative extrude for the slope macro\n"
+                yield str(gcode) + "\n"
+                yield "M82 ; enable absolute extrude mode\n"
+                yield f"G92 E{Gcode._format_number(extruder_position, 5)} ; set extruder position\n"
+                continue
+            if gcode.command == "G92":
+                e = gcode.get_param("E")
+                if e is not None:
+                    extruder_position = e
+            elif gcode.command in ("G0", "G1") and gcode.is_extruder_move():
+                extruded = gcode.get_param("E")
+                extruder_position += extruded
+                if gcode.command == "G1" and gcode.is_xy_movement() is False and extruded != 0:
+                    comment = "retract" if extruded < 0 else "un_retract"
+                    gcode.comment = comment if gcode.comment is None else f"{gcode.comment} {comment}"
+                gcode.set_param("E", extruder_position)
+                gcode.extrude_is_absolute = True
+        yield str(gcode) + "\n"
+
+
+class StageScope(Enum):
+    LINE = 0  # one command at a time
+    LOOP = 1  # closed loops found in a layer
+    LAYER = 2  # all commands of a layer
+    FILE = 3  # all commands of the file, can't be fused with other stages
+
+
+class Stage:
+    """
+    Transform of the gcode commands. A stage declares the context it needs with scope
+    and implements the process method of that scope
+    """
+    scope = StageScope.LINE
+    name = "stage"
+
+    def process_line(self, gcode: Gcode) -> List[Gcode]:
+        return [gcode]
+
+    def find_loops(self, gcodes: List[Gcode]):
+        """
+        :return: start end indexes of the loops and the index from which the commands have to wait for the next layer
+        """
+        return [], len(gcodes)
+
+    def process_loop(self, loop_gcodes: List[Gcode]) -> List[Gcode]:
+        return loop_gcodes
+
+    def process_layer(self, gcodes: List[Gcode]) -> List[Gcode]:
+        return gcodes
+
+    def process_file(self, gcodes: List[Gcode]) -> List[Gcode]:
+        return gcodes
+
+    def finish(self) -> List[Gcode]:
+        """
+        :return: commands held back by the stage, called after the last command
+        """
+        return []
+
+
+class Pipeline:
+    """
+    Runs the stages in order. Consecutive line, loop and layer stages are fused in to one pass over the commands,
+    every file stage takes a pass of its own
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        self.timings = {stage: 0.0 for stage in stages}  # keyed by the instance, names of stages can repeat
+
+    def passes(self) -> List[List[Stage]]:
+        passes = []
+        for stage in self.stages:
+            if stage.scope == StageScope.FILE or len(passes) == 0 or passes[-1][0].scope == StageScope.FILE:
+                passes.append([stage])
+            else:
+                passes[-1].append(stage)
+        return passes
+
+    def run(self, gcodes: List[Gcode]) -> List[Gcode]:
+        for stages in self.passes():
+            if stages[0].scope == StageScope.FILE:
+                start = time.perf_counter()
+                gcodes = stages[0].process_file(gcodes)
+                self.timings[stages[0]] += time.perf_counter() - start
+                continue
+
+            stream = iter(gcodes)
+            for stage in stages:
+                if stage.scope == StageScope.LINE:
+                    stream = self._line_stream(stage, stream)
+                else:
+                    stream = self._layer_stream(stage, stream)
+            gcodes = list(stream)
+        return gcodes
+
+    def _line_stream(self, stage: Stage, gcodes):
+        for gcode in gcodes:
+            start = time.perf_counter()
+            produced = stage.process_line(gcode)
+            self.timings[stage] += time.perf_counter() - start
+            yield from produced
+        yield from self._finish(stage)
+
+    def _layer_stream(self, stage: Stage, gcodes):
+        layer = []
+        for gcode in gcodes:
+            if gcode.command == LAYER_CHANGE_MARKER and len(layer) > 0:
+                produced, layer = self._process_layer(stage, layer, last=False)
+                yield from produced
+            layer.append(gcode)
+        if len(layer) > 0:
+            produced, _ = self._process_layer(stage, layer, last=True)
+            yield from produced
+        yield from self._finish(stage)
+
+    def _process_layer(self, stage: Stage, layer: List[Gcode], last: bool):
+        start = time.perf_counter()
+        carried = []
+        if stage.scope == StageScope.LAYER:
+            produced = stage.process_layer(layer)
+        else:
+            loops, carry_from = stage.find_loops(layer)
+            if not last:  # a loop which is not finished yet is completed in the next layer
+                carried = layer[carry_from:]
+                layer = layer[:carry_from]
+            produced = []
+            done = 0
+            for loop_start, loop_end in loops:
+                produced.extend(layer[done:loop_start])
+                produced.extend(stage.process_loop(layer[loop_start:loop_end + 1]))
+                done = loop_end + 1
+            produced.extend(layer[done:])
+        self.timings[stage] += time.perf_counter() - start
+        return produced, carried
+
+    def _finish(self, stage: Stage):
+        start = time.perf_counter()
+        produced = stage.finish()
+        self.timings[stage] += time.perf_counter() - start
+        return produced
+
+    def timings_summary(self) -> str:
+        return ", ".join(f"{stage.name} {round(seconds, 3)} s" for stage, seconds in self.timings.items())
+
+
+class RelativeExtrudeStage(Stage):
+    name = "relative extrude"
+
+    def __init__(self):
+        self.relative_extrude_enabled = False
+
+    def process_line(self, gcode: Gcode) -> List[Gcode]:
         if gcode.command == "M82":  # pass enable absolute mode command
-            continue
+            return []
 
-        gcode_new = gcode.clone()
-        gcode_new.extrude_is_absolute = False
+        produced = []
+        if not self.relative_extrude_enabled and gcode.command == "G1":
+            produced.append(Gcode(command="M83", comment="enable relative extrude mode"))
+            self.relative_extrude_enabled = True
 
-        if len(gcodes_new) > 1:
-            gcode_new.previous_state = gcodes_new[-1].state()
+        if gcode.previous_state is not None:
+            if (gcode.command in ("G0", "G1") and gcode.is_extruder_move()
+                    and gcode.previous_state.extrude_is_absolute):
+                relative_extrude_length = gcode.get_param("E") - gcode.previous_state.E
+                gcode.set_param("E", relative_extrude_length)
+            gcode.previous_state.extrude_is_absolute = False
+        gcode.extrude_is_absolute = False
+        produced.append(gcode)
+        return produced
 
-        if gcode.is_extruder_move():
-            if gcode.previous_state.extrude_is_absolute:
-                relative_extrude_length = gcode.get_param("E") - gcode_new.previous_state.E
-                gcode_new.set_param("E", relative_extrude_length)
-            gcodes_new.append(gcode_new)
+
+class SpeedInCommandStage(Stage):
+    """
+    Move the speed of a standalone "G1 F.." command in to the next move command
+    """
+    name = "speed in command"
+
+    def __init__(self):
+        self.held = []  # standalone speed command and the commands after it
+
+    def process_line(self, gcode: Gcode) -> List[Gcode]:
+        if (gcode.command == "G1" and gcode.get_param("F") is not None
+                and gcode.is_any_movement() is False and gcode.is_extruder_move() is False):
+            produced = self.held[1:]  # the previous speed change is overridden, nothing in between moved
+            self.held = [gcode]
+            return produced
+
+        if len(self.held) == 0:
+            return [gcode]
+
+        if gcode.command not in ("G0", "G1"):  # doesn't depend on the speed
+            self.held.append(gcode)
+            return []
+
+        produced = self.held
+        self.held = []
+        if gcode.command == "G1" and gcode.is_any_movement() and gcode.get_param("F") is None:
+            gcode.set_param("F", produced[0].get_param("F"))
+            produced = produced[1:]
+        # any other move (extruder only, own speed, G0) uses the held speed as it is
+        produced.append(gcode)
+        return produced
+
+    def finish(self) -> List[Gcode]:
+        produced = self.held
+        self.held = []
+        return produced
+
+
+class SlopePathSlots:
+    """
+    Loop points stored on the printer for the slope macro. The number of slots is bounded,
+    the least recently used slot is overwritten by a new path
+    """
+
+    def __init__(self, max_slots: int = 64, tolerance: float = 0.001):
+        self.max_slots = max_slots
+        self.tolerance = tolerance
+        self.cleared = False  # the slots left from a previous print are dropped before the first definition
+        self._slots = OrderedDict()  # loop shape -> (E of the moves, slot id, stored points)
+
+    def get(self, key):
+        """
+        :return: (slot id, stored points) of the path or None if it is not stored
+        """
+        shape, extrusions = key
+        found = self._slots.get(shape)
+        if found is None or not same_extrusions(found[0], extrusions):
+            return None
+        self._slots.move_to_end(shape)
+        return found[1], found[2]
+
+    def add(self, key, points: str) -> int:
+        shape, extrusions = key
+        if shape in self._slots:
+            slot_id = self._slots.pop(shape)[1]
+        elif len(self._slots) >= self.max_slots:
+            slot_id = self._slots.popitem(last=False)[1][1]
         else:
-            gcodes_new.append(gcode_new)
+            slot_id = len(self._slots) + 1
+        self._slots[shape] = (extrusions, slot_id, points)
+        return slot_id
 
-    return gcodes_new
 
+class SeamSlopeStage(Stage):
+    """
+    Replace closed outer perimeter loops with sloped ones
+    """
+    scope = StageScope.LOOP
+    name = "seam slope"
+
+    def __init__(self, slope_min_length: float, slope_steps: int, layer_height: float, start_slope_height: float,
+                 first_layer_height: float, cache: SlopeTemplateCache = None, paths: SlopePathSlots = None):
+        self.slope_min_length = slope_min_length
+        self.slope_steps = slope_steps
+        self.layer_height = layer_height
+        self.start_slope_height = start_slope_height
+        self.first_layer_height = first_layer_height
+        self.cache = cache
+        self.loops = []  # (first line number, last line number, modified loop) of every modified loop
+        self.found_loops = 0
+        self.paths = paths  # sloped loops are written as slope macro calls if set
+        self.expanded_commands = 0
+        self.expanded_bytes = 0
+        self.compact_commands = 0
+        self.compact_bytes = 0
+
+    def find_loops(self, gcodes: List[Gcode]):
+        loops, open_loop_start = find_closed_loops(gcodes, 0.4, self.slope_min_length,
+                                                   first_layer_height=self.first_layer_height)
+        for _ in loops:
+            self.found_loops += 1
+            print(f"Found a loop number {self.found_loops}")
+        return loops, len(gcodes) if open_loop_start is None else open_loop_start
+
+    def process_loop(self, loop_gcodes: List[Gcode]) -> List[Gcode]:
+        print(f"Add a slope to perimeter {len(self.loops)}")
+        modified_loop = modify_loop_with_slope(loop_gcodes, self.slope_steps, layer_height=self.layer_height,
+                                               start_slope_height=self.start_slope_height, cache=self.cache)
+        compact_loop = None if self.paths is None else self.compact_loop(loop_gcodes)
+        if compact_loop is None:
+            self.loops.append((loop_gcodes[0].num_line, loop_gcodes[-1].num_line, modified_loop))
+            return modified_loop
+
+        # the commands run by the macro are verified, not the explicit form
+        self.loops.append((loop_gcodes[0].num_line, loop_gcodes[-1].num_line, compact_loop[-1].expanded))
+        self.expanded_commands += len(modified_loop)
+        self.expanded_bytes += sum(len(str(gcode)) + 1 for gcode in modified_loop)
+        self.compact_commands += len(compact_loop)
+        self.compact_bytes += sum(len(str(gcode)) + 1 for gcode in compact_loop)
+        return compact_loop
+
+    def compact_loop(self, loop_gcodes: List[Gcode]) -> List[Gcode]:
+        """
+        :return: the slope macro call preceded by the path definition when the path is new, None if not possible
+        """
+        if not can_compact_loop(loop_gcodes):
+            return None
+        key = loop_shape_key(loop_gcodes, self.paths.tolerance, self.slope_steps)
+        if key is None:
+            return None
+
+        produced = []
+        found = self.paths.get(key)
+        if found is None:
+            if not self.paths.cleared:
+                produced.append(Gcode(command=f"{SLOPE_PATH_MACRO} CLEAR=1", comment="drop paths of previous prints"))
+                self.paths.cleared = True
+            points = slope_ramp_points(loop_gcodes, self.slope_steps)
+            path_id = self.paths.add(key, points)
+            produced.append(Gcode(command=f"{SLOPE_PATH_MACRO} ID={path_id} POINTS={points}"))
+        else:
+            path_id, points = found  # the printer runs the stored points of the same loop
+
+        layer_level = loop_gcodes[0].state().Z - self.layer_height
+        z_floor = Gcode._format_number(layer_level, 5)
+        z_end = Gcode._format_number(layer_level + self.layer_height, 5)
+        start_ratio = Gcode._format_number(self.start_slope_height / self.layer_height, 5)
+        command = (f"{SLOPE_RAMP_MACRO} PATH={path_id} Z_FLOOR={z_floor} Z_END={z_end} START_RATIO={start_ratio} "
+                   f"STEPS={self.slope_steps}")
+        speed = loop_gcodes[0].get_param("F")
+        if speed is not None:
+            command += f" F={speed}"
+        lines = slope_ramp_lines(points, float(z_floor), float(z_end), float(start_ratio), self.slope_steps, speed)
+        expanded = parse_gcode_lines(lines, loop_gcodes[0].previous_state)
+        produced.append(SlopeRampGcode(command, expanded, comment="Sloped loop"))
+        return produced
 
-def include_speed_in_command(gcodes: List[Gcode]):
-    gcodes_new = []
-    gcode_speed_change = None
-    print("Include speed command in to move command")
-    for gcode in gcodes:
-        index = gcodes.index(gcode)
-        if index % 100 == 0:
-            print(f"{index} of {len(gcodes)}")
-        gcodes_new.append(gcode)
-        if gcode.command == "G1":
-            if gcode.get_param("F") is not None and gcode.is_any_movement() is False:
-                if gcode_speed_change is not None:
-                    gcodes_new.remove(gcode_speed_change)
-                gcode_speed_change = gcode
-                continue
 
-            if gcode_speed_change is not None and gcode.is_any_movement() and gcode.get_param("F") is None:
-                gcode.set_param("F", gcode_speed_change.get_param("F"))
-                gcodes_new.remove(gcode_speed_change)
-                gcode_speed_change = None
+class MotionReplay:
+    """
+    Positions and extrusion of a gcode sequence replayed into flat lists, one entry per command
+    """
 
-    return gcodes_new
+    def __init__(self):
+        self.x = []
+        self.y = []
+        self.z = []
+        self.e = []  # filament extruded by the command, always relative
+        self.xy = []  # XY length of the command movement
+        self.layer_starts = []  # indexes of the layer change markers
+
+
+def replay_gcodes(gcodes: List[Gcode], start_state: State = None) -> MotionReplay:
+    """
+    Replay gcode commands independently of the states stored in them
+    :param gcodes:
+    :param start_state: position and modes before the first command
+    :return:
+    """
+    if start_state is None:
+        start_state = State(0, 0, 0, 0)
+    x, y, z, e = start_state.X, start_state.Y, start_state.Z, start_state.E
+    move_absolute = start_state.move_is_absolute
+    extrude_absolute = start_state.extrude_is_absolute
+
+    replay = MotionReplay()
+    for index, gcode in enumerate(expand_slope_ramps(gcodes)):
+        command = gcode.command
+        extruded = 0
+        xy_length = 0
+        if command == "G1" or command == "G0":
+            new_x, new_y = x, y
+            for parameter in gcode.parameters:
+                value = parameter.value
+                if value is None:
+                    continue
+                if parameter.name == "X":
+                    new_x = value if move_absolute else x + value
+                elif parameter.name == "Y":
+                    new_y = value if move_absolute else y + value
+                elif parameter.name == "Z":
+                    z = value if move_absolute else z + value
+                elif parameter.name == "E":
+                    extruded = value - e if extrude_absolute else value
+                    e += extruded
+            xy_length = math.hypot(new_x - x, new_y - y)
+            x, y = new_x, new_y
+        elif command == "G92":
+            for parameter in gcode.parameters:
+                if parameter.name == "X":
+                    x = parameter.value
+                elif parameter.name == "Y":
+                    y = parameter.value
+                elif parameter.name == "Z":
+                    z = parameter.value
+                elif parameter.name == "E":
+                    e = parameter.value
+        elif command == "G28":
+            axes = [parameter.name for parameter in gcode.parameters]
+            if "X" in axes or not axes:
+                x = 0
+            if "Y" in axes or not axes:
+                y = 0
+            if "Z" in axes or not axes:
+                z = 0
+        elif command == "G90":
+            move_absolute = True
+        elif command == "G91":
+            move_absolute = False
+        elif command == "M82":
+            extrude_absolute = True
+        elif command == "M83":
+            extrude_absolute = False
+        elif command == LAYER_CHANGE_MARKER:
+            replay.layer_starts.append(index)
+
+        replay.x.append(x)
+        replay.y.append(y)
+        replay.z.append(z)
+        replay.e.append(extruded)
+        replay.xy.append(xy_length)
+    return replay
+
+
+def replay_states(gcodes: List[Gcode]) -> MotionReplay:
+    """
+    Replay parsed gcode commands from the states stored by the parser, the parameters are not interpreted again
+    :param gcodes: commands as returned by parse_gcode_lines, before any stage changed them
+    :return:
+    """
+    replay = MotionReplay()
+    if len(gcodes) == 0:
+        return replay
+    before = [State(0, 0, 0, 0) if gcodes[0].previous_state is None else gcodes[0].previous_state]
+    before.extend(gcode.previous_state for gcode in gcodes[1:])
+    after = before[1:] + [gcodes[-1].state()]
+    moves = [gcode.command == "G1" for gcode in gcodes]  # the states follow only G1 moves
+
+    replay.x = [state.X for state in after]
+    replay.y = [state.Y for state in after]
+    replay.z = [state.Z for state in after]
+    replay.e = [state.E - previous.E if move else 0 for move, previous, state in zip(moves, before, after)]
+    replay.xy = [math.hypot(state.X - previous.X, state.Y - previous.Y) if move else 0
+                 for move, previous, state in zip(moves, before, after)]
+    replay.layer_starts = [index for index, gcode in enumerate(gcodes) if gcode.command == LAYER_CHANGE_MARKER]
+    return replay
+
+
+def layer_extrusions(gcodes: List[Gcode], start_state: State = None, layers: set = None) -> List[float]:
+    """
+    Filament extruded by every layer, replayed independently of the states stored in the commands
+    :param gcodes:
+    :param start_state: position and modes before the first command
+    :param layers: indexes of the layers to replay, 0 is the part before the first layer change. The commands
+    have to be in relative extrude mode, the other layers are None. All layers are replayed if not set
+    :return:
+    """
+    if layers is None:
+        replay = replay_gcodes(gcodes, start_state)
+        extruded = list(accumulate(replay.e, initial=0))
+        bounds = [0] + replay.layer_starts + [len(replay.e)]
+        return [extruded[end] - extruded[start] for start, end in zip(bounds, bounds[1:])]
+
+    bounds = [index for index, gcode in enumerate(gcodes) if gcode.command == LAYER_CHANGE_MARKER]
+    bounds = [0] + bounds + [len(gcodes)]
+    return [_relative_extrusion(gcodes[start:end]) if layer in layers else None
+            for layer, (start, end) in enumerate(zip(bounds, bounds[1:]))]
+
+
+def _relative_extrusion(gcodes: List[Gcode]) -> float:
+    extruded = 0
+    for gcode in expand_slope_ramps(gcodes):
+        if gcode.command == "G1" or gcode.command == "G0":
+            for parameter in gcode.parameters:
+                if parameter.name == "E" and parameter.value is not None:
+                    extruded += parameter.value
+    return extruded
+
+
+def _position_on_polyline(segments: List[tuple], arc_starts: List[float], cursor: int, x: float, y: float,
+                          tolerance: float):
+    """
+    Find the polyline segment the point lies on, searching forward from the cursor and wrapping around
+    :param segments: (start X, start Y, X difference, Y difference, squared length) of every segment
+    :return: (segment index, arc length position of the point) or None if the point is off the polyline
+    """
+    for shift in range(len(segments)):
+        segment = cursor + shift
+        if segment >= len(segments):
+            segment -= len(segments)
+        x1, y1, dx, dy, squared_length = segments[segment]
+        t = 0 if squared_length == 0 else ((x - x1) * dx + (y - y1) * dy) / squared_length
+        if t < 0:
+            t = 0
+        elif t > 1:
+            t = 1
+        if math.hypot(x1 + dx * t - x, y1 + dy * t - y) <= tolerance:
+            if t == 1:
+                return segment, arc_starts[segment + 1]
+            return segment, arc_starts[segment] + (arc_starts[segment + 1] - arc_starts[segment]) * t
+    return None
+
+
+def loop_path_coverage(input_replay: MotionReplay, first: int, last: int, loop_replay: MotionReplay,
+                       start_x: float, start_y: float, tolerance: float):
+    """
+    Check that every extruded move of the modified loop lies on the input loop polyline
+    :return: covered arc length of the input loop, its full length and the number of moves off the polyline
+    """
+    points = [(input_replay.x[first - 1], input_replay.y[first - 1])]
+    points.extend((input_replay.x[index], input_replay.y[index])
+                  for index in range(first, last + 1) if input_replay.xy[index] > 0)
+    arc_starts = list(accumulate((math.hypot(x2 - x1, y2 - y1) for (x1, y1), (x2, y2) in zip(points, points[1:])),
+                                 initial=0))
+    loop_length = arc_starts[-1]
+    if len(points) < 2 or loop_length == 0:
+        return 0, 0, 0
+    segments = [(x1, y1, x2 - x1, y2 - y1, (x2 - x1) ** 2 + (y2 - y1) ** 2)
+                for (x1, y1), (x2, y2) in zip(points, points[1:])]
+
+    intervals = []
+    off_path = 0
+    cursor = 0
+    start = None  # polyline position of the previous point, known when the previous move was on the polyline
+    previous_x, previous_y = start_x, start_y
+    for x, y, extruded in zip(loop_replay.x, loop_replay.y, loop_replay.e):
+        if x == previous_x and y == previous_y:
+            continue
+        end = None
+        if extruded > 0:
+            if start is None:
+                start = _position_on_polyline(segments, arc_starts, cursor, previous_x, previous_y, tolerance)
+            end = None if start is None else _position_on_polyline(segments, arc_starts, start[0], x, y, tolerance)
+            middle = end
+            # a move with both ends on one segment stays on it, the start can be the first point of the end segment
+            if end is not None and end[0] != start[0] and start[1] != arc_starts[end[0]]:
+                middle = _position_on_polyline(segments, arc_starts, start[0], (previous_x + x) / 2,
+                                               (previous_y + y) / 2, tolerance)
+            if middle is None:
+                off_path += 1
+                end = None
+            else:
+                cursor = end[0]
+                start_position, end_position = start[1], end[1]
+                if start_position >= loop_length - tolerance and end_position < start_position:
+                    start_position = 0  # the seam point is both the start and the end of the loop
+                if end_position < start_position:
+                    intervals.append((start_position, loop_length))
+                    intervals.append((0, end_position))
+                else:
+                    intervals.append((start_position, end_position))
+        start = end
+        previous_x, previous_y = x, y
+
+    covered = 0
+    covered_to = 0
+    for start_position, end_position in sorted(intervals):
+        if end_position > covered_to:
+            covered += end_position - max(start_position, covered_to)
+            covered_to = end_position
+    return covered, loop_length, off_path
+
+
+def verify_output(input_replay: MotionReplay, output_layers: List[float], loops: list,
+                  layer_height: float, tolerance: float) -> List[str]:
+    """
+    Check that the output extrudes the same filament as the input and that the sloped loops are sane
+    :param input_replay: replay of the file as it was read
+    :param output_layers: filament extruded by every layer of the output, None for a layer passed through unchanged
+    :param loops: (first input index, last input index, modified loop gcodes) for every modified loop
+    :param layer_height:
+    :param tolerance: allowed difference of extruded filament and of XY positions in mm
+    :return: list of found problems, empty if the output is fine
+    """
+    problems = []
+    input_e = list(accumulate(input_replay.e, initial=0))
+    input_bounds = [0] + input_replay.layer_starts + [len(input_replay.e)]
+    input_layers = [input_e[end] - input_e[start] for start, end in zip(input_bounds, input_bounds[1:])]
+
+    if len(input_layers) != len(output_layers):
+        problems.append(f"Layer count differs: input {len(input_layers)} output {len(output_layers)}")
+    else:
+        output_layers = [input_layer_e if output_layer_e is None else output_layer_e
+                         for input_layer_e, output_layer_e in zip(input_layers, output_layers)]
+        if abs(sum(input_layers) - sum(output_layers)) > tolerance:
+            problems.append(f"Total extrusion differs: input E={round(sum(input_layers), 4)} "
+                            f"output E={round(sum(output_layers), 4)}")
+        for layer, (input_layer_e, output_layer_e) in enumerate(zip(input_layers, output_layers)):
+            if abs(input_layer_e - output_layer_e) > tolerance:
+                problems.append(f"Layer {layer} extrusion differs: input E={round(input_layer_e, 4)} "
+                                f"output E={round(output_layer_e, 4)}")
+
+    for loop_number, (first, last, modified_loop) in enumerate(loops, start=1):
+        start_state = State(input_replay.x[first - 1], input_replay.y[first - 1], input_replay.z[first - 1], 0,
+                            extrude_absolute=False)
+        loop_replay = replay_gcodes(modified_loop, start_state)
+
+        input_loop_e = input_e[last + 1] - input_e[first]
+        output_loop_e = sum(loop_replay.e)
+        if abs(input_loop_e - output_loop_e) > tolerance:
+            problems.append(f"Loop {loop_number} extrusion differs: input E={round(input_loop_e, 4)} "
+                            f"output E={round(output_loop_e, 4)}")
+
+        covered, input_loop_length, off_path = loop_path_coverage(input_replay, first, last, loop_replay,
+                                                                  start_state.X, start_state.Y, tolerance)
+        if off_path > 0:
+            problems.append(f"Loop {loop_number} has {off_path} extruded moves off the input loop path")
+        if covered < input_loop_length - tolerance:
+            problems.append(f"Loop {loop_number} path is not covered: input length={round(input_loop_length, 3)} "
+                            f"covered length={round(covered, 3)}")
+
+        layer_floor = input_replay.z[first] - layer_height
+        lowest_z = min(loop_replay.z)
+        if lowest_z < layer_floor - 1e-6:
+            problems.append(f"Loop {loop_number} goes below the layer floor: Z={round(lowest_z, 4)} "
+                            f"floor={round(layer_floor, 4)}")
+
+    return problems
+
+
+def load_stage(path: str) -> Stage:
+    """
+    :param path: "module:Class" of a stage with a constructor without arguments
+    :return:
+    """
+    module_name, class_name = path.split(":", 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def process_gcodes(gcodes: List[Gcode], args, start_state: State = None,
+                   cache: SlopeTemplateCache = None, paths: SlopePathSlots = None) -> List[Gcode]:
+    first_num_line = gcodes[0].num_line
+    input_replay = replay_states(gcodes) if args.verify else None
+
+    slope_stage = SeamSlopeStage(args.slope_min_length, args.slope_steps, layer_height=args.other_layers,
+                                 start_slope_height=args.start_slope_height, first_layer_height=args.first_layer,
+                                 cache=cache, paths=paths)
+    stages = [RelativeExtrudeStage(), slope_stage]
+    stages.extend(load_stage(path) for path in args.stages)
+    pipeline = Pipeline(stages)
+    print(f"Process gcode with {len(stages)} stages in {len(pipeline.passes())} passes")
+    gcode_for_save = pipeline.run(gcodes)
+    print(f"Stage timings: {pipeline.timings_summary()}")
+    if slope_stage.paths is not None and slope_stage.expanded_commands > 0:
+        print(f"Compact slopes: {slope_stage.compact_commands} commands {slope_stage.compact_bytes} bytes instead of "
+              f"{slope_stage.expanded_commands} commands {slope_stage.expanded_bytes} bytes, saved "
+              f"{round(100 - 100 * slope_stage.compact_bytes / slope_stage.expanded_bytes, 1)}% of the size")
+
+    verify_loops = [(first - first_num_line, last - first_num_line, modified_loop)
+                    for first, last, modified_loop in slope_stage.loops]
+
+    if args.verify:
+        print("Verify the output")
+        verify_start = time.perf_counter()
+        # the built-in stages change only the layers with sloped loops, other stages may change any layer
+        sloped_layers = None if len(args.stages) > 0 else {bisect_right(input_replay.layer_starts, first)
+                                                           for first, _, _ in verify_loops}
+        output_layers = layer_extrusions(gcode_for_save, start_state, sloped_layers)
+        problems = verify_output(input_replay, output_layers, verify_loops,
+                                 layer_height=args.other_layers, tolerance=args.verify_tolerance)
+        print(f"Verification took {round(time.perf_counter() - verify_start, 3)} s")
+        if len(problems) > 0:
+            for problem in problems:
+                print(problem)
+            raise Exception(f"Verification failed with {len(problems)} problems, the file is not written")
+
+    return gcode_for_save
+
+
+def process_layer_regions(data: bytes, args, cache: SlopeTemplateCache = None,
+                          paths: SlopePathSlots = None) -> List[bytes]:
+    """
+    Parse and process only the selected layers, everything else is copied byte by byte
+    :param data: content of the gcode file
+    :param args:
+    :param cache: templates of already sloped loops
+    :param paths: loop points stored for the slope macro, shared by all regions
+    :return: chunks of the output file
+    """
+    layers = scan_layers(data)
+    if len(layers) == 0:
+        raise Exception(f"No {LAYER_CHANGE_MARKER} markers found, layer selection is not possible")
+
+    regions = select_layer_regions(layers, len(data), z_min=args.z_min, z_max=args.z_max,
+                                   layer_numbers=args.layers)
+    print(f"Found {len(layers)} layers, {len(regions)} regions selected for processing")
+
+    chunks = []
+    copied_to = 0
+    state = State(0, 0, 0, 0)  # state and line number are carried forward from one region to the next
+    num_line = 1
+    for region_id, (region_start, region_end) in enumerate(regions):
+        chunks.append(data[copied_to:region_start])
+
+        start_state = seed_state(data, copied_to, region_start, state)
+        num_line += data.count(b"\n", copied_to, region_start)
+        lines = data[region_start:region_end].decode('utf8').splitlines()
+        gcodes = parse_gcode_lines(lines, start_state, first_num_line=num_line)
+
+        if region_end < len(data):  # a loop ending the region is closed by the first travel of the next layer
+            last_layer = next((index for index in range(len(gcodes) - 1, -1, -1)
+                               if gcodes[index].command == LAYER_CHANGE_MARKER), 0)
+            _, open_loop_start = find_closed_loops(gcodes[last_layer:], 0.4, args.slope_min_length,
+                                                   first_layer_height=args.first_layer)
+            if open_loop_start is not None:
+                search_end = regions[region_id + 1][0] if region_id + 1 < len(regions) else len(data)
+                tail_end = find_loop_closing_travel(data, region_end, search_end, gcodes[-1].state())
+                lines = data[region_end:tail_end].decode('utf8').splitlines()
+                gcodes.extend(parse_gcode_lines(lines, gcodes[-1].state(), first_num_line=num_line + len(gcodes)))
+                region_end = tail_end
+        end_state = gcodes[-1].state()
+        state = end_state
+        num_line += data.count(b"\n", region_start, region_end)
+        copied_to = region_end
+        gcode_for_save = process_gcodes(gcodes, args, start_state, cache=cache, paths=paths)
+
+        start_e = start_state.E if start_state.extrude_is_absolute else 0
+        lines = gcode_lines(gcode_for_save, absolute_extrude=args.absolute_extrude, start_e=start_e)
+        chunks.append("".join(lines).encode('utf8'))
+
+        if region_end < len(data):  # the rest of the file is left untouched
+            restore = []
+            if end_state.extrude_is_absolute:
+                restore.append("M82 ; restore absolute extrude mode\n")
+                restore.append(f"G92 E{Gcode._format_number(end_state.E, 5)} ; restore extruder position\n")
+            elif args.absolute_extrude:
+                restore.append("M83 ; restore relative extrude mode\n")
+            chunks.append("".join(restore).encode('utf8'))
+
+    chunks.append(data[copied_to:])
+    return chunks
+
+
+def positive_int(string: str) -> int:
+    try:
+        value = int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{string}' is not an integer")
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f"{string} has to be greater than 0")
+    return value
+
+
+def positive_float(string: str) -> float:
+    try:
+        value = float(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{string}' is not a number")
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f"{string} has to be greater than 0")
+    return value
 
 
 def main():
@@ -715,52 +1863,46 @@ def main():
     parser.add_argument('--slope_steps', dest='slope_steps', default=10, type=int)
     parser.add_argument('--start_slope_height', dest='start_slope_height', default=0.1, type=float)
     parser.add_argument('--save_to_file', dest='save_to_file', default=None, type=bool)
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='check extrusion and geometry of the output before writing it')
+    parser.add_argument('--verify_tolerance', dest='verify_tolerance', default=0.01, type=float)
+    parser.add_argument('--z-min', dest='z_min', default=None, type=float,
+                        help='process only layers with Z greater or equal')
+    parser.add_argument('--z-max', dest='z_max', default=None, type=float,
+                        help='process only layers with Z less or equal')
+    parser.add_argument('--layers', dest='layers', default=None, type=parse_layer_numbers,
+                        help='process only the listed layers counted from 1, like 5-20,30')
+    parser.add_argument('--absolute_extrude', dest='absolute_extrude', action='store_true',
+                        help='write the output with absolute extrude (M82)')
+    parser.add_argument('--slope_cache_size', dest='slope_cache_size', default=64, type=int,
+                        help='number of sloped loop templates reused on the next layers, 0 disables the cache')
+    parser.add_argument('--slope_cache_tolerance', dest='slope_cache_tolerance', default=0.001, type=positive_float,
+                        help='XY tolerance in mm for loops to be considered the same')
+    parser.add_argument('--compact_slopes', dest='compact_slopes', action='store_true',
+                        help='write every sloped loop as one Klipper macro call')
+    parser.add_argument('--compact_path_slots', dest='compact_path_slots', default=64, type=positive_int,
+                        help='number of loop paths stored on the printer for the slope macro')
+    parser.add_argument('--stage', dest='stages', action='append', default=[],
+                        help='additional transform stage as module:Class, can be repeated')
 
     args = parser.parse_args()
 
-    first_layer_height = args.first_layer
-    layer_height = args.other_layers
-    slope_min_length = args.slope_min_length
-    slope_steps = args.slope_steps
-    start_slope_height = args.start_slope_height
     save_to_file = args.save_to_file
 
     file_path = args.path
 
     # prusa_env_output_name = str(os.getenv('SLIC3R_PP_OUTPUT_NAME'))
-    gcodes = read_gcode_file(file_path)
-    # gcodes = include_speed_in_command(gcodes)
-    gcodes = convert_to_relative_extrude(gcodes)
-
-    closed_loop_ids = find_closed_loops(gcodes, 0.4, slope_min_length,
-                                        first_layer_height=first_layer_height)  # start end indexes
-    closed_loops_with_data = []
-    for cl_id in closed_loop_ids:
-        print(f"Add a slope to perimeter {closed_loop_ids.index(cl_id)}")
-        modified_loop = modify_loop_with_slope(gcodes[cl_id[0]: cl_id[1] + 1], slope_steps,
-                                               layer_height=layer_height, start_slope_height=start_slope_height)
-        closed_loops_with_data.append((cl_id, modified_loop))
-
-    gcode_for_save = []
-    last_id = -1
-    print(f"Compiling the gcode file")
-    for original_gcode_id in range(len(gcodes)):
-        if original_gcode_id <= last_id:
-            continue
-        if len(closed_loops_with_data) > 0:
-            closed_loop = closed_loops_with_data[0]
-            closed_loop_id_range = closed_loop[0]
-            closed_loop_id_data = closed_loop[1]
-            closed_loop_start_id = closed_loop_id_range[0]
-            closed_loop_end_id = closed_loop_id_range[1]
-            if original_gcode_id != closed_loop_start_id:
-                gcode_for_save.append(gcodes[original_gcode_id])
-            else:
-                gcode_for_save.extend(closed_loop_id_data)
-                last_id = closed_loop_end_id
-                closed_loops_with_data.remove(closed_loops_with_data[0])
-        else:
-            gcode_for_save.append(gcodes[original_gcode_id])
+    cache = SlopeTemplateCache(args.slope_cache_size, args.slope_cache_tolerance)
+    paths = SlopePathSlots(args.compact_path_slots, args.slope_cache_tolerance) if args.compact_slopes else None
+    partial = args.z_min is not None or args.z_max is not None or args.layers is not None
+    if partial:
+        with open(file_path, "rb") as readfile:
+            data = readfile.read()
+        readfile.close()
+        chunks = process_layer_regions(data, args, cache=cache, paths=paths)
+    else:
+        gcodes = read_gcode_file(file_path)
+        gcode_for_save = process_gcodes(gcodes, args, cache=cache, paths=paths)
 
     destFilePath = file_path
     if save_to_file is not None:
@@ -768,11 +1910,25 @@ def main():
         destFilePath = re.sub(r'\.gcode$', '', file_path) + '_post_processed.gcode'
 
     delete_file_if_exists(destFilePath)
-    with open(destFilePath, "w", encoding='utf-8') as writefile:
-        for gcode in gcode_for_save:
-            writefile.write(str(gcode) + "\n")
+    if partial:
+        with open(destFilePath, "wb") as writefile:
+            writefile.writelines(chunks)
+    else:
+        with open(destFilePath, "w", encoding='utf-8') as writefile:
+            writefile.writelines(gcode_lines(gcode_for_save, absolute_extrude=args.absolute_extrude))
     writefile.close()
 
+    if args.compact_slopes:
+        macros_path = re.sub(r'\.gcode$', '', destFilePath) + '_seam_slope_macros.cfg'
+        with open(macros_path, "w", encoding='utf-8') as macros_file:
+            macros_file.write(SLOPE_MACROS_CONFIG)
+        macros_file.close()
+        print(f"Slope macros are written to {macros_path}")
+
+    if cache.max_size > 0:
+        print(f"Slope template cache: {cache.hits} hits, {cache.misses} misses")
+
 
 if __name__ == '__main__':
+    sys.modules.setdefault('postprocessor_seam_slope', sys.modules[__name__])  # stages import the script by name
     main()